@@ -32,6 +32,8 @@ setup(
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     get-users-data = presence_analyzer.script:get_users_data
+    benchmark = presence_analyzer.benchmark:run
+    load-test = presence_analyzer.loadtest:run
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
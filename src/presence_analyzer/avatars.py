@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of user avatars fetched from the intranet.
+"""
+
+import os
+import imghdr
+import urllib2
+import threading
+from time import time as cur_time
+
+from presence_analyzer.utils import atomic_write
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# Avatars are kept in this subdirectory of the instance folder
+# unless AVATAR_CACHE_DIR is set.
+CACHE_SUBDIRECTORY = 'avatars'
+DEFAULT_CACHE_SIZE = 10 * 1024 * 1024
+
+# Seconds before avatar which could not be fetched is requested again.
+DEFAULT_RETRY_AFTER = 3600
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+class AvatarCache(object):
+    """
+    Directory of avatar images limited in size by LRU eviction.
+
+    Modification time of a file is its last use time. Users whose avatars
+    could not be fetched are not requested again for retry_after seconds.
+    """
+
+    def __init__(self, directory, max_size, timeout=10,
+                 retry_after=DEFAULT_RETRY_AFTER):
+        self.directory = directory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.pending = set()
+        self.failures = {}
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, user_id):
+        """
+        Returns path of cached avatar of given user.
+        """
+        return os.path.join(self.directory, str(user_id))
+
+    def get(self, user_id):
+        """
+        Returns path of cached avatar and marks it as used, or None.
+        """
+        path = self.path(user_id)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def store(self, user_id, content):
+        """
+        Saves avatar and evicts least recently used ones above size limit.
+        """
+        atomic_write(self.path(user_id), content)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used avatars until cache fits its limit.
+        """
+        with self.lock:
+            files = []
+            for name in os.listdir(self.directory):
+                if name.startswith('.'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+            files.sort()
+            total = sum(size for _, size, _ in files)
+            for _, size, name in files:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                total -= size
+
+    def fetch(self, user_id, url):
+        """
+        Downloads avatar and stores it in cache.
+        """
+        failed = True
+        try:
+            content = urllib2.urlopen(url, timeout=self.timeout).read()
+            if imghdr.what(None, content) is None:
+                log.warning('Avatar of user %s is not an image', user_id)
+                return
+            self.store(user_id, content)
+            failed = False
+        except (IOError, OSError) as exc:
+            log.warning('Fetching avatar of user %s failed: %s', user_id, exc)
+        finally:
+            with self.lock:
+                self.pending.discard(user_id)
+                if failed:
+                    self.failures[user_id] = cur_time()
+                else:
+                    self.failures.pop(user_id, None)
+
+    def fetch_async(self, user_id, url):
+        """
+        Downloads avatar in background unless it is already being fetched
+        or fetching it failed recently.
+        """
+        with self.lock:
+            if user_id in self.pending:
+                return None
+            failed_at = self.failures.get(user_id)
+            if (failed_at is not None and
+                    cur_time() < failed_at + self.retry_after):
+                return None
+            self.pending.add(user_id)
+        thread = threading.Thread(target=self.fetch, args=(user_id, url))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def get_avatar_cache(app):
+    """
+    Returns avatar cache configured for given application.
+    """
+    directory = app.config.get('AVATAR_CACHE_DIR') or os.path.join(
+        app.instance_path, CACHE_SUBDIRECTORY
+    )
+    max_size = app.config.get('AVATAR_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+    with _CACHES_LOCK:
+        if (directory, max_size) not in _CACHES:
+            _CACHES[directory, max_size] = AvatarCache(directory, max_size)
+        return _CACHES[directory, max_size]
+
+
+def image_mimetype(path):
+    """
+    Detects mimetype of image file.
+    """
+    return 'image/{}'.format(imghdr.what(path) or 'png')
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for data loading, aggregation and endpoints.
+"""
+
+import os
+import sys
+import json
+import shutil
+import random
+import argparse
+import tempfile
+import platform
+import subprocess
+from datetime import date, timedelta
+from time import time as cur_time
+
+from presence_analyzer.main import app
+from presence_analyzer import utils, views
+from presence_analyzer.avatars import get_avatar_cache
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# Run in a fresh interpreter to measure startup:
+# argv is csv_path, xml_path, warm_up flag and URL of the first request.
+STARTUP_SCRIPT = '''
+import sys, json
+from time import time
+started = time()
+from presence_analyzer import app, views
+imported = time()
+app.config.update({'DATA_CSV': sys.argv[1], 'DATA_XML': sys.argv[2]})
+if sys.argv[3] == '1':
+    views.warm_up()
+ready = time()
+app.test_client().get(sys.argv[4])
+print json.dumps({
+    'import': imported - started,
+    'warm_up': ready - imported,
+    'first_response': time() - ready,
+    'total': time() - started,
+})
+'''
+
+# Values used to fill URL rule arguments when requesting every route.
+ROUTE_ARGUMENTS = {
+    'template': 'presence_weekday',
+    'group_id': 'all',
+    'report': 'presence_weekday',
+}
+
+
+def generate_data(directory, users=100, years=1, seed=0):
+    """
+    Generates synthetic presence CSV and users XML files.
+
+    Every user gets one entry for each working day in given amount of years.
+    Returns tuple of paths (csv_path, xml_path).
+    """
+    rand = random.Random(seed)
+    csv_path = os.path.join(directory, 'bench_data.csv')
+    xml_path = os.path.join(directory, 'bench_users.xml')
+    first_day = date(2013, 1, 1)
+    days = [
+        first_day + timedelta(days=i)
+        for i in xrange(365 * years)
+        if (first_day + timedelta(days=i)).weekday() < 5
+    ]
+
+    with open(csv_path, 'w') as csvfile:
+        for user_id in xrange(1, users + 1):
+            for day in days:
+                start = rand.randint(7 * 3600, 11 * 3600)
+                end = start + rand.randint(3 * 3600, 10 * 3600)
+                csvfile.write('{},{},{},{}\n'.format(
+                    user_id,
+                    day.isoformat(),
+                    _format_seconds(start),
+                    _format_seconds(end),
+                ))
+
+    with open(xml_path, 'w') as xmlfile:
+        xmlfile.write(
+            '<?xml version="1.0" encoding="UTF-8" ?>\n'
+            '<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.stxnext.pl</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n'
+            '    <users>\n'
+        )
+        for user_id in xrange(1, users + 1):
+            xmlfile.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>User {0}.</name>\n'
+                '        </user>\n'.format(user_id)
+            )
+        xmlfile.write('    </users>\n</intranet>\n')
+
+    return csv_path, xml_path
+
+
+def _format_seconds(seconds):
+    """
+    Formats amount of seconds since midnight as HH:MM:SS.
+    """
+    return '{:02d}:{:02d}:{:02d}'.format(
+        seconds // 3600, seconds % 3600 // 60, seconds % 60
+    )
+
+
+def measure(function, repeat, setup=None):
+    """
+    Calls function given amount of times and returns timing statistics.
+
+    Optional setup function is called before every call and is not timed.
+    """
+    timings = []
+    for _ in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = cur_time()
+        function()
+        timings.append(cur_time() - start)
+    timings.sort()
+    return {
+        'repeat': repeat,
+        'min': timings[0],
+        'max': timings[-1],
+        'mean': sum(timings) / len(timings),
+        'median': timings[len(timings) // 2],
+    }
+
+
+def _safe_measure(function, repeat, setup=None):
+    """
+    Measures function and records an error instead of failing the suite.
+    """
+    try:
+        return measure(function, repeat, setup)
+    except Exception as exc:  # pylint: disable-msg=W0703
+        log.warning('Benchmark failed: %s', exc, exc_info=True)
+        return {'error': '{}: {}'.format(type(exc).__name__, exc)}
+
+
+def _clear_cache():
+    """
+    Drops all cached data so next call loads it from disk.
+    """
+    utils.CACHE.clear()
+
+
+def _clear_users_cache():
+    """
+    Drops cached users data so next call parses the XML file.
+    """
+    utils.CACHE.pop(utils.USERS_CACHE_KEY, None)
+
+
+def iter_routes(user_id):
+    """
+    Yields (endpoint, url) for every application route with sample arguments.
+    """
+    arguments = dict(ROUTE_ARGUMENTS, user_id=user_id)
+    with app.test_request_context():
+        from flask import url_for
+        for rule in app.url_map.iter_rules():
+            if rule.endpoint == 'static':
+                continue
+            if not set(rule.arguments) <= set(arguments):
+                log.warning('Skipping route %s, no sample arguments', rule)
+                continue
+            values = {key: arguments[key] for key in rule.arguments}
+            yield rule.endpoint, url_for(rule.endpoint, **values)
+
+
+def run_benchmarks(csv_path, xml_path, repeat=10):
+    """
+    Runs all benchmarks against given data files and returns results.
+    """
+    app.config.update({'DATA_CSV': csv_path, 'DATA_XML': xml_path})
+    results = {}
+
+    results['get_data_cold'] = _safe_measure(
+        utils.get_data, repeat, setup=_clear_cache
+    )
+    utils.get_data()
+    results['get_data_warm'] = _safe_measure(utils.get_data, repeat)
+    results['get_data_xml'] = _safe_measure(
+        utils.get_data_xml, repeat, setup=_clear_users_cache
+    )
+
+    data = utils.get_data()
+
+    def group_all(grouping):
+        for items in data.itervalues():
+            grouping(items)
+
+    results['group_by_weekday'] = _safe_measure(
+        lambda: group_all(utils.group_by_weekday), repeat
+    )
+    results['group_start_end_by_weekday'] = _safe_measure(
+        lambda: group_all(utils.group_start_end_by_weekday), repeat
+    )
+
+    # Avatar route is measured against a private cache holding an avatar
+    # of the benchmarked user, so no images are fetched from the intranet.
+    user_id = min(data) if data else 0
+    app.config['AVATAR_CACHE_DIR'] = os.path.join(
+        os.path.dirname(os.path.abspath(csv_path)), 'avatars'
+    )
+    with open(views.AVATAR_PLACEHOLDER, 'rb') as placeholder:
+        get_avatar_cache(app).store(user_id, placeholder.read())
+
+    client = app.test_client()
+    for endpoint, url in iter_routes(user_id):
+        status = client.get(url).status_code
+        if status >= 400:
+            log.warning('Skipping route %s, status %d', url, status)
+            results['view:' + endpoint] = {
+                'error': 'GET {} returned {}'.format(url, status),
+            }
+            continue
+        results['view:' + endpoint] = _safe_measure(
+            lambda url=url: client.get(url), repeat
+        )
+
+    return results
+
+
+def measure_startup(csv_path, xml_path, repeat, warm_up=False,
+                    url='/templates/presence_weekday'):
+    """
+    Measures import time and time to first response in fresh interpreters.
+
+    Returns mean of every measured phase (see STARTUP_SCRIPT).
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    runs = []
+    for _ in xrange(repeat):
+        output = subprocess.check_output([
+            sys.executable, '-c', STARTUP_SCRIPT,
+            csv_path, xml_path, '1' if warm_up else '0', url,
+        ], env=env)
+        runs.append(json.loads(output.splitlines()[-1]))
+    return {
+        phase: sum(run[phase] for run in runs) / len(runs)
+        for phase in runs[0]
+    }
+
+
+def _git_revision():
+    """
+    Returns current git commit hash or None when not available.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(__file__),
+            stderr=open(os.devnull, 'w'),
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """
+    Compares two benchmark reports and returns mean time ratios (new/old).
+    """
+    ratios = {}
+    for name, stats in new['results'].iteritems():
+        old_stats = old['results'].get(name, {})
+        if 'mean' in stats and old_stats.get('mean'):
+            ratios[name] = stats['mean'] / old_stats['mean']
+    return ratios
+
+
+def run(argv=None):
+    """
+    Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write JSON report to this file')
+    parser.add_argument('--compare', help='JSON report to compare against')
+    parser.add_argument('--startup', action='store_true',
+                        help='also measure import and first response time')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='presence_bench_')
+    try:
+        csv_path, xml_path = generate_data(
+            directory, users=args.users, years=args.years, seed=args.seed
+        )
+        report = {
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'time': cur_time(),
+            'parameters': {
+                'users': args.users,
+                'years': args.years,
+                'repeat': args.repeat,
+                'seed': args.seed,
+            },
+            'results': run_benchmarks(
+                csv_path, xml_path, repeat=args.repeat
+            ),
+        }
+        if args.startup:
+            for warm_up in (False, True):
+                name = 'startup_warm_up' if warm_up else 'startup'
+                report['results'][name] = measure_startup(
+                    csv_path, xml_path, args.repeat, warm_up=warm_up
+                )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output)
+    else:
+        print output
+
+    if args.compare:
+        with open(args.compare) as report_file:
+            ratios = compare(json.load(report_file), report)
+        for name in sorted(ratios):
+            sys.stderr.write('{:40s} {:6.2f}x\n'.format(name, ratios[name]))
+
+
+if __name__ == '__main__':
+    run()
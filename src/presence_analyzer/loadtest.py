@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-threaded load generator for the presence analyzer WSGI application.
+"""
+
+import json
+import math
+import random
+import httplib
+import argparse
+import threading
+from time import time as cur_time
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+DEFAULT_MIX = (
+    ('/api/v2/users', 1),
+    ('/api/v1/presence_weekday/{user_id}', 3),
+    ('/api/v1/mean_time_weekday/{user_id}', 3),
+    ('/api/v1/presence_start_end/{user_id}', 3),
+)
+
+
+def percentile(values, pct):
+    """
+    Returns given percentile of sorted values using nearest-rank method.
+    """
+    if not values:
+        return 0
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def parse_mix(items):
+    """
+    Parses request mix given as 'path' or 'path=weight' strings.
+    """
+    mix = []
+    for item in items:
+        path, _, weight = item.partition('=')
+        mix.append((path, int(weight) if weight else 1))
+    return tuple(mix)
+
+
+def wsgi_sender(app):
+    """
+    Returns factory of senders calling WSGI application in-process.
+    """
+    def factory():
+        client = app.test_client()
+
+        def send(path):
+            return client.get(path).status_code
+        return send
+    return factory
+
+
+def http_sender(host, port):
+    """
+    Returns factory of senders issuing HTTP requests over a socket.
+    """
+    def factory():
+        def send(path):
+            connection = httplib.HTTPConnection(host, port)
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                return response.status
+            finally:
+                connection.close()
+        return send
+    return factory
+
+
+def serve_paste(app, workers, spawn_if_under, max_requests):
+    """
+    Starts Paste threaded HTTP server on a free local port.
+
+    Uses the same threadpool options as deploy.ini. Returns the server.
+    """
+    from paste import httpserver
+    server = httpserver.serve(
+        app,
+        host='127.0.0.1',
+        port=0,
+        start_loop=False,
+        use_threadpool=True,
+        threadpool_workers=workers,
+        threadpool_options={
+            'spawn_if_under': spawn_if_under,
+            'max_requests': max_requests,
+        },
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run_load(sender_factory, mix, user_ids, concurrency=10, requests=1000,
+             seed=0):
+    """
+    Sends requests from concurrent threads and returns statistics.
+
+    Paths in the request mix may contain {user_id} placeholder, which is
+    replaced with a random id from user_ids.
+    """
+    paths = [path for path, weight in mix for _ in xrange(weight)]
+    user_ids = list(user_ids) or [0]
+    latencies = []
+    errors = []
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def worker(number):
+        rand = random.Random(seed + number)
+        send = sender_factory()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            path = rand.choice(paths).format(user_id=rand.choice(user_ids))
+            start = cur_time()
+            try:
+                status = send(path)
+            except Exception as exc:  # pylint: disable-msg=W0703
+                status = type(exc).__name__
+            elapsed = cur_time() - start
+            with lock:
+                latencies.append(elapsed)
+                if status != 200:
+                    errors.append(status)
+
+    threads = [
+        threading.Thread(target=worker, args=(i,))
+        for i in xrange(concurrency)
+    ]
+    start = cur_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = cur_time() - start
+
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'duration': duration,
+        'rps': len(latencies) / duration if duration else 0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def run(argv=None):
+    """
+    Command line entry point.
+    """
+    from presence_analyzer import script, utils
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--config', default=script.DEPLOY_CFG,
+                        help='application config, relative to buildout')
+    parser.add_argument('--mode', choices=('wsgi', 'paste', 'url'),
+                        default='wsgi',
+                        help='in-process WSGI calls, local Paste server '
+                             'or already running server given by --url')
+    parser.add_argument('--url', default='127.0.0.1:8101',
+                        help='host:port used in url mode')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--workers', default='50',
+                        help='comma separated threadpool sizes to compare')
+    parser.add_argument('--spawn-if-under', type=int, default=5)
+    parser.add_argument('--max-requests', type=int, default=200)
+    parser.add_argument('--path', action='append', default=[],
+                        help='request path, optionally with =weight')
+    parser.add_argument('--output', help='write JSON report to this file')
+    args = parser.parse_args(argv)
+
+    app = script.make_app(config=args.config)
+    mix = parse_mix(args.path) if args.path else DEFAULT_MIX
+    user_ids = utils.get_data().keys()
+
+    def load(sender_factory):
+        return run_load(
+            sender_factory, mix, user_ids,
+            concurrency=args.concurrency, requests=args.requests,
+        )
+
+    results = []
+    if args.mode == 'wsgi':
+        results.append(load(wsgi_sender(app)))
+    elif args.mode == 'url':
+        host, _, port = args.url.partition(':')
+        results.append(load(http_sender(host, int(port or 80))))
+    else:
+        for workers in [int(i) for i in args.workers.split(',')]:
+            server = serve_paste(
+                app, workers, args.spawn_if_under, args.max_requests
+            )
+            try:
+                result = load(http_sender(*server.server_address[:2]))
+            finally:
+                server.server_close()
+            result.update({
+                'workers': workers,
+                'spawn_if_under': args.spawn_if_under,
+                'max_requests': args.max_requests,
+            })
+            results.append(result)
+
+    line = (
+        '{workers!s:>7} workers  {concurrency:4d} clients  '
+        '{rps:9.1f} req/s  p50 {p50:.4f}s  p95 {p95:.4f}s  '
+        'p99 {p99:.4f}s  errors {errors}'
+    )
+    for result in results:
+        print line.format(**dict({'workers': '-'}, **result))
+
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(results, report_file, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    run()
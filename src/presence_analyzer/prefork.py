@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-fork multi-process WSGI server.
+
+The master process binds the listening socket, optionally loads the dataset
+and forks worker processes, which share both the socket and the loaded data
+(copy-on-write). Workers are replaced one generation at a time when data
+files change or the master receives SIGHUP.
+"""
+
+import os
+import sys
+import errno
+import signal
+from time import sleep, time as cur_time
+
+from werkzeug.serving import BaseWSGIServer
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+def preload_data(reload=False):
+    """
+    Loads the dataset and templates, so forked workers share them.
+
+    Data already loaded, e.g. by WARM_UP, is reused unless reload is set.
+    When reloading fails, previously loaded data is kept.
+    """
+    from presence_analyzer import utils, views
+    if not reload:
+        views.warm_up()
+        return
+    previous = {}
+    for key in (0, utils.USERS_CACHE_KEY, utils.GROUPS_CACHE_KEY):
+        if key in utils.CACHE:
+            previous[key] = utils.CACHE.pop(key)
+    try:
+        views.warm_up()
+    except Exception:
+        utils.CACHE.update(previous)
+        raise
+
+
+def data_files_mtime(app):
+    """
+    Returns modification times of data files used by the application.
+    """
+    mtimes = []
+    for key in ('DATA_CSV', 'DATA_XML'):
+        try:
+            mtimes.append(os.stat(app.config[key]).st_mtime)
+        except (KeyError, OSError):
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+class PreforkServer(object):
+    """
+    Serves WSGI application from a pool of forked worker processes.
+    """
+    # Seconds between checks of workers and data files.
+    check_interval = 1.0
+
+    def __init__(self, app, host='0.0.0.0', port=8101, workers=4,
+                 preload=True, watch=True, users_sync=None):
+        self.app = app
+        self.workers = workers
+        self.preload = preload
+        self.watch = watch
+        # Users synchronization run by the master between worker checks.
+        self.users_sync = users_sync
+        self.next_users_sync = 0
+        self.server = BaseWSGIServer(host, port, app)
+        # Workers wait for connections at most check_interval, also in
+        # accept() after another one took the connection they were all
+        # woken up for.
+        self.server.socket.settimeout(self.check_interval)
+        self.server.timeout = self.check_interval
+        self.children = set()
+        # Workers of previous generation, while they are being replaced.
+        self.retiring = set()
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def serve_forever(self):
+        """
+        Runs the master process loop until SIGTERM or SIGINT.
+        """
+        signal.signal(signal.SIGHUP, self._request_reload)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        log.info(
+            'Serving on http://%s:%d with %d workers',
+            self.server.server_address[0], self.server.server_address[1],
+            self.workers
+        )
+        self.sync_users()
+        if self.preload:
+            preload_data()
+        mtime = data_files_mtime(self.app)
+        self.spawn_workers()
+        try:
+            while not self.stop_requested:
+                sleep(self.check_interval)
+                self.reap_workers()
+                if self.sync_users():
+                    self.reload_requested = True
+                if self.watch and data_files_mtime(self.app) != mtime:
+                    log.info('Data files changed, reloading workers')
+                    self.reload_requested = True
+                if self.reload_requested:
+                    self.reload_requested = False
+                    mtime = data_files_mtime(self.app)
+                    self.reload()
+                elif len(self.children) < self.workers:
+                    self.spawn_workers()
+        finally:
+            self.stop_workers(self.children | self.retiring)
+            self.server.server_close()
+
+    def sync_users(self):
+        """
+        Synchronizes users XML when its interval has passed.
+
+        Returns True when the local file was updated.
+        """
+        if self.users_sync is None or cur_time() < self.next_users_sync:
+            return False
+        self.next_users_sync = cur_time() + self.users_sync.interval
+        return self.users_sync.sync()
+
+    def spawn_workers(self):
+        """
+        Forks workers until the pool is full.
+        """
+        while len(self.children) < self.workers:
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker()
+            self.children.add(pid)
+
+    def reload(self):
+        """
+        Replaces all workers with new ones, reloading data first.
+
+        Old workers finish requests they are handling before they exit.
+        When data cannot be loaded, old workers keep serving.
+        """
+        if self.preload:
+            try:
+                preload_data(reload=True)
+            except Exception:  # pylint: disable-msg=W0703
+                log.exception('Reloading data failed, keeping old workers')
+                return
+        self.retiring = self.children
+        self.children = set()
+        self.spawn_workers()
+        self.stop_workers(self.retiring)
+        self.retiring = set()
+
+    def reap_workers(self):
+        """
+        Forgets workers which have exited.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid in self.children:
+                log.warning('Worker %d exited with status %d', pid, status)
+                self.children.discard(pid)
+
+    def stop_workers(self, children):
+        """
+        Asks given workers to stop and waits for them.
+        """
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+    def _run_worker(self):
+        """
+        Handles requests in a forked worker process until SIGTERM.
+        """
+        stopping = []
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+        status = 0
+        try:
+            while not stopping:
+                self.server.handle_request()
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Worker %d crashed', os.getpid())
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)  # pylint: disable-msg=W0212
+
+    def _request_reload(self, signum, frame):
+        """
+        SIGHUP handler.
+        """
+        self.reload_requested = True
+
+    def _request_stop(self, signum, frame):
+        """
+        SIGTERM and SIGINT handler.
+        """
+        self.stop_requested = True
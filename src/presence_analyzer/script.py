@@ -9,8 +9,6 @@ from functools import partial
 import paste.script.command
 import werkzeug.script
 
-import urllib2
-
 etc = partial(os.path.join, 'parts', 'etc')
 
 DEPLOY_INI = etc('deploy.ini')
@@ -26,12 +24,22 @@ for i in range(2 + __name__.count('.')):
 abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
+_users_sync = None
+
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False,
+             users_sync=True):
+    global _users_sync
     from presence_analyzer import app
+    from presence_analyzer.users_sync import start_users_sync
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if users_sync and _users_sync is None:
+        _users_sync = start_users_sync(app)
+    if app.config.get('WARM_UP'):
+        from presence_analyzer.views import warm_up
+        warm_up()
     return app
 
 
@@ -80,6 +88,23 @@ def _serve(action, debug=False, dry_run=False):
     paste.script.command.run()
 
 
+def _serve_prefork(workers, host, port, preload=True, watch=True,
+                   debug=False):
+    """Serve the application from a pool of forked worker processes."""
+    from presence_analyzer.prefork import PreforkServer
+    from presence_analyzer.users_sync import make_users_sync
+    # Workers are forked, so users are synchronized by the master
+    # instead of a background thread.
+    if debug:
+        app = make_app(config=DEBUG_CFG, debug=True, users_sync=False)
+    else:
+        app = make_app(users_sync=False)
+    PreforkServer(
+        app, host=host, port=port, workers=workers,
+        preload=preload, watch=watch, users_sync=make_users_sync(app),
+    ).serve_forever()
+
+
 # bin/flask-ctl ...
 def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
@@ -102,6 +127,21 @@ def run():
         """Serve the debugging application."""
         _serve(action, debug=True, dry_run=dry_run)
 
+    # bin/flask-ctl prefork [-w 4] [-p 8101]
+    def action_prefork(workers=('w', 4), host=('h', '0.0.0.0'),
+                       port=('p', 8101), preload=True, watch=True,
+                       debug=False):
+        """Serve the application from pre-forked worker processes.
+
+        The master process loads the dataset before forking (unless
+        '--no-preload' is given), so workers share it copy-on-write.
+        Workers are gracefully replaced when data files change (unless
+        '--no-watch' is given) or when the master receives SIGHUP.
+        """
+        _serve_prefork(
+            workers, host, port, preload=preload, watch=watch, debug=debug
+        )
+
     # bin/flask-ctl status
     def action_status(dry_run=False):
         """Status of the application."""
@@ -115,10 +155,13 @@ def run():
     werkzeug.script.run()
 
 
+# bin/get-users-data
 def get_users_data():
-    req = urllib2.Request(app.config['USERS'])
-    XML = urllib2.urlopen(req)
-
-    XML_file = open('runtime/data/users_info.xml', 'w')
-    XML_file.write(XML.read())
-    XML_file.close()
+    """Download users XML from the intranet if it has changed."""
+    from presence_analyzer import app
+    from presence_analyzer.users_sync import sync_users
+    app.config.from_pyfile(abspath(DEPLOY_CFG))
+    if sync_users(app.config['USERS'], app.config['DATA_XML']):
+        print 'Updated', app.config['DATA_XML']
+    else:
+        print 'Not modified', app.config['DATA_XML']
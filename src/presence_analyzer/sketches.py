@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable streaming quantile sketches.
+"""
+
+import math
+from bisect import bisect_left
+
+
+class QuantileSketch(object):
+    """
+    Approximates quantiles of values in seconds using sparse histogram.
+
+    Values are counted in buckets of given resolution, so memory is bounded
+    by number of distinct buckets (1440 per day for one minute resolution)
+    and quantiles are exact up to one bucket. Sketches with the same
+    resolution can be merged without loss.
+
+    Sorted buckets with cumulative counts are built on the first query after
+    a change, so repeated quantile queries are binary searches.
+    """
+
+    def __init__(self, resolution=60):
+        self.resolution = resolution
+        self.counts = {}
+        self.total = 0
+        self._index = None
+
+    def __len__(self):
+        return self.total
+
+    def add(self, value):
+        """
+        Adds value to the sketch.
+        """
+        bucket = int(value) // self.resolution
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self._index = None
+
+    def merge(self, other):
+        """
+        Adds all values of other sketch to this one.
+        """
+        if other.resolution != self.resolution:
+            raise ValueError('Cannot merge sketches of different resolution')
+        for bucket, count in other.counts.iteritems():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        self._index = None
+        return self
+
+    def index(self):
+        """
+        Returns sorted buckets and cumulative counts up to each of them.
+        """
+        if self._index is None:
+            buckets = sorted(self.counts)
+            cumulative = []
+            seen = 0
+            for bucket in buckets:
+                seen += self.counts[bucket]
+                cumulative.append(seen)
+            self._index = (buckets, cumulative)
+        return self._index
+
+    def quantile(self, fraction):
+        """
+        Returns approximate quantile (nearest-rank), zero for no values.
+
+        Result is the middle of the bucket holding the value.
+        """
+        if not self.total:
+            return 0
+        rank = max(int(math.ceil(fraction * self.total)), 1)
+        buckets, cumulative = self.index()
+        position = min(bisect_left(cumulative, rank), len(buckets) - 1)
+        return (buckets[position] + 0.5) * self.resolution
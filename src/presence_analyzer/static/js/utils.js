@@ -2,4 +2,53 @@ function parseInterval(value) {
     var result = new Date(1,1,1);
     result.setMilliseconds(value*1000);
     return result;
-}
\ No newline at end of file
+}
+
+// Reports are kept for the same time as data on the server.
+var REPORT_MAX_AGE = 600 * 1000;
+var reports = {};
+
+function storageGet(key) {
+    try {
+        return JSON.parse(window.sessionStorage.getItem(key));
+    } catch(e) {
+        return null;
+    }
+}
+
+function storageSet(key, value) {
+    try {
+        window.sessionStorage.setItem(key, JSON.stringify(value));
+    } catch(e) {
+        // Storage is disabled or full, reports are kept in memory only.
+    }
+}
+
+// Calls callback with a copy of combined report of given user. Report is
+// fetched once and reused by all tabs while it is fresh.
+function getReport(userId, callback) {
+    var key = 'report:' + userId;
+    var cached = reports[key] || storageGet(key);
+    if(cached && new Date().getTime() - cached.time < REPORT_MAX_AGE) {
+        reports[key] = cached;
+        callback($.extend(true, {}, cached.data));
+        return;
+    }
+    $.getJSON("/api/v1/report/"+userId, function(result) {
+        reports[key] = {time: new Date().getTime(), data: result};
+        storageSet(key, reports[key]);
+        callback($.extend(true, {}, result));
+    });
+}
+
+// Remembers selected user, so it is shown again after switching tabs.
+function rememberUser(userId) {
+    storageSet('user_id', userId);
+}
+
+function restoreUser(dropdown) {
+    var userId = storageGet('user_id');
+    if(userId && dropdown.find('option[value="'+userId+'"]').length) {
+        dropdown.val(userId).change();
+    }
+}
@@ -2,12 +2,26 @@
 """
 Presence analyzer unit tests.
 """
+import os
 import os.path
+import sys
 import json
+import time
+import signal
+import shutil
+import socket
+import httplib
 import datetime
+import tempfile
 import unittest
+import threading
+import subprocess
+import BaseHTTPServer
 
-from presence_analyzer import main, views, utils
+from presence_analyzer import (
+    main, views, utils, benchmark, loadtest, prefork, users_sync, avatars,
+    sketches
+)
 
 
 TEST_DATA_CSV = os.path.join(
@@ -19,6 +33,11 @@ TEST_CACHE_DATA_CSV1 = os.path.join(
     '..', '..', 'runtime', 'data', 'test_data_cache1.csv'
 )
 
+TEST_INVALID_DATA_CSV = os.path.join(
+    os.path.dirname(__file__),
+    '..', '..', 'runtime', 'data', 'test_data_invalid.csv'
+)
+
 TEST_DATA_XML = os.path.join(
     os.path.dirname(__file__),
     '..', '..', 'runtime', 'data', 'users_test.xml'
@@ -138,6 +157,203 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             ]
         )
 
+    def test_report_view(self):
+        """
+        Test combined report matches separate views.
+        """
+        resp = self.client.get('/api/v1/report/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        for view in ('presence_weekday', 'mean_time_weekday',
+                     'presence_start_end'):
+            expected = json.loads(
+                self.client.get('/api/v1/{}/10'.format(view)).data
+            )
+            self.assertEqual(data[view], expected)
+
+        resp = self.client.get('/api/v1/report/999')
+        self.assertEqual(json.loads(resp.data), {
+            u'presence_weekday': [],
+            u'mean_time_weekday': [],
+            u'presence_start_end': [],
+        })
+
+    def test_ingest_status_view(self):
+        """
+        Test report of the last data load.
+        """
+        utils.CACHE = {}
+        resp = self.client.get('/api/v1/ingest_status')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data['rows'], 9)
+        self.assertEqual(data['accepted'], 9)
+        self.assertEqual(data['rejected'], 0)
+        self.assertEqual(data['policy'], 'skip')
+        self.assertEqual(len(data['version']), 12)
+        self.assertIn('duration', data)
+
+    def test_ingest_status_view_failure(self):
+        """
+        Test report of a failed data load.
+        """
+        utils.CACHE = {}
+        main.app.config.update({
+            'DATA_CSV': TEST_INVALID_DATA_CSV,
+            'INGEST_POLICY': 'fail',
+        })
+        try:
+            resp = self.client.get('/api/v1/ingest_status')
+        finally:
+            del main.app.config['INGEST_POLICY']
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['error'], 'Invalid user_id in line 2')
+        self.assertIsNone(data['serving'])
+
+    def test_groups_view(self):
+        """
+        Test groups listing.
+        """
+        utils.CACHE = {}
+        resp = self.client.get('/api/v1/groups')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(json.loads(resp.data), [
+            {u'group_id': u'all', u'name': u'All users'},
+            {u'group_id': u'dev', u'name': u'Developers'},
+        ])
+
+    def test_group_views(self):
+        """
+        Test group aggregates.
+        """
+        utils.CACHE = {}
+        resp = self.client.get('/api/v1/group/dev/presence_weekday')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data),
+            json.loads(self.client.get('/api/v1/presence_weekday/10').data)
+        )
+
+        resp = self.client.get('/api/v1/group/all/mean_time_weekday')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1], [u'Tue', 23305.5])
+
+        resp = self.client.get('/api/v1/group/all/presence_start_end')
+        data = json.loads(resp.data)
+        self.assertEqual(data[0], [u'Mon', 33134.0, 57257.0])
+
+        resp = self.client.get('/api/v1/group/nope/presence_weekday')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_presence_quantiles_view(self):
+        """
+        Test presence quantiles view.
+        """
+        utils.CACHE = {}
+        resp = self.client.get('/api/v1/presence_quantiles/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[0], [u'Mon', 0, 0, 0, 0, 0, 0])
+        self.assertEqual(data[1], [
+            u'Tue', 30030.0, 30030.0, 34770.0, 34770.0, 64770.0, 64770.0
+        ])
+
+        resp = self.client.get('/api/v1/group/all/presence_quantiles')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1], [
+            u'Tue', 16590.0, 30030.0, 33570.0, 34770.0, 50130.0, 64770.0
+        ])
+
+        resp = self.client.get('/api/v1/presence_quantiles/999')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_export_view(self):
+        """
+        Test exporting reports of all users as CSV.
+        """
+        utils.CACHE = {}
+        resp = self.client.get('/api/v1/export/presence_weekday.csv')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/csv; charset=utf-8')
+        self.assertEqual(resp.data.splitlines(), [
+            'user_id,Mon,Tue,Wed,Thu,Fri,Sat,Sun',
+            '10,0,30047,24465,23705,0,0,0',
+            '11,24123,16564,25321,45968,6426,0,0',
+        ])
+
+        resp = self.client.get('/api/v1/export/mean_time_weekday.csv')
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[1], '10,0,30047.0,24465.0,23705.0,0,0,0')
+
+        resp = self.client.get('/api/v1/export/presence_start_end.csv')
+        lines = resp.data.splitlines()
+        self.assertEqual(lines[0].split(',')[:3], [
+            'user_id', 'Mon start', 'Mon end'
+        ])
+        self.assertEqual(
+            lines[1].split(',')[:5], ['10', '0', '0', '34745.0', '64792.0']
+        )
+
+        resp = self.client.get('/api/v1/export/unknown.csv')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_warm_up(self):
+        """
+        Test loading data and templates ahead of requests.
+        """
+        utils.CACHE = {}
+        views.warm_up()
+        self.assertIn(0, utils.CACHE)
+        self.assertIn('summaries', utils.CACHE)
+        self.assertIn('mako', main.app.extensions)
+        self.assertItemsEqual(views.PAGE_TEMPLATES, [
+            'mean_time_weekday', 'presence_start_end', 'presence_weekday'
+        ])
+        self.assertIn(('', 'presence_weekday'), views.RENDERED_PAGES)
+
+    def test_lazy_imports(self):
+        """
+        Test importing the package does not load lxml nor Mako.
+        """
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, presence_analyzer; '
+            'print sorted(name for name in sys.modules '
+            'if name.split(".")[0] in ("lxml", "mako", "flask_mako"))',
+        ], env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        self.assertEqual(output.strip(), '[]')
+
+    def test_template_handler(self):
+        """
+        Test rendering pages.
+        """
+        views.RENDERED_PAGES.clear()
+        resp = self.client.get('/templates/presence_weekday')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/html; charset=utf-8')
+        self.assertIn('Presence by weekday', resp.data)
+        self.assertEqual(
+            views.RENDERED_PAGES[('', 'presence_weekday')], resp.data
+        )
+
+        views.RENDERED_PAGES[('', 'presence_weekday')] = 'cached'
+        resp = self.client.get('/templates/presence_weekday')
+        self.assertEqual(resp.data, 'cached')
+        views.RENDERED_PAGES.clear()
+
+        resp = self.client.get('/templates/missing')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/templates/base_view')
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(views.RENDERED_PAGES, {})
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -256,6 +472,210 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             6: {'end': [], 'start': []}}
         )
 
+    def test_summarize_by_weekday(self):
+        """
+        Test summarizing entries by weekday.
+        """
+        data = utils.get_data()
+
+        result = utils.summarize_by_weekday(data[10])
+        self.assertEqual(result[0], {
+            'count': 0, 'presence': 0, 'start': 0, 'end': 0
+        })
+        self.assertEqual(result[1], {
+            'count': 1, 'presence': 30047, 'start': 34745, 'end': 64792
+        })
+
+    def test_get_data_invalid_rows(self):
+        """
+        Test invalid rows are skipped and counted.
+        """
+        main.app.config.update({'DATA_CSV': TEST_INVALID_DATA_CSV})
+        data = utils.get_data()
+        self.assertItemsEqual(data[10].keys(), [
+            datetime.date(2013, 9, 10),
+            datetime.date(2013, 9, 11),
+        ])
+        self.assertItemsEqual(data[11].keys(), [datetime.date(2013, 9, 5)])
+        self.assertEqual(utils.INGEST_STATUS['rows'], 7)
+        self.assertEqual(utils.INGEST_STATUS['accepted'], 3)
+        self.assertEqual(utils.INGEST_STATUS['errors'], {
+            'user_id': 1, 'date': 1, 'interval': 1, 'columns': 1
+        })
+
+    def test_ingest_quarantine(self):
+        """
+        Test invalid rows are written to quarantine file.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            quarantine = os.path.join(directory, 'rejected.csv')
+            utils.ingest_csv(
+                TEST_INVALID_DATA_CSV, 'quarantine', quarantine
+            )
+            with open(quarantine) as rejected:
+                lines = rejected.read().splitlines()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(lines, [
+            'user,date,start,end,2,user_id',
+            '10,2013-13-11,09:19:52,16:07:37,4,date',
+            '11,2013-09-09,15:54:17,09:12:14,6,interval',
+            '11,2013-09-10,09:19:50,7,columns',
+        ])
+
+    def test_ingest_header_footer(self):
+        """
+        Test header, footer and empty lines are not rejected.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'data.csv')
+            with open(path, 'w') as csvfile:
+                csvfile.write(
+                    'user,date,start,end\n'
+                    '10,2013-09-10,09:39:05,17:59:52\n'
+                    '\n'
+                    '11,2013-09-05,09:28:08,15:51:27\n'
+                    'Total: 2 entries\n'
+                )
+            data, status = utils.ingest_csv(path, 'fail')
+            utils.ingest_csv(path, 'quarantine')
+            with open(path + '.rejected') as rejected:
+                lines = rejected.read().splitlines()
+        finally:
+            shutil.rmtree(directory)
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(status['rows'], 2)
+        self.assertEqual(status['skipped'], 3)
+        self.assertEqual(status['rejected'], 0)
+        self.assertEqual(lines, [])
+
+    def test_ingest_fail(self):
+        """
+        Test loading fails on first invalid row with 'fail' policy.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_INVALID_DATA_CSV,
+            'INGEST_POLICY': 'fail',
+        })
+        try:
+            with self.assertRaises(utils.IngestError) as context:
+                utils.get_data()
+        finally:
+            del main.app.config['INGEST_POLICY']
+        self.assertEqual(context.exception.line, 2)
+        self.assertEqual(context.exception.kind, 'user_id')
+        self.assertEqual(
+            utils.INGEST_STATUS['error'], 'Invalid user_id in line 2'
+        )
+        self.assertNotIn(0, utils.CACHE)
+
+    def test_ingest_fail_keeps_last_data(self):
+        """
+        Test last loaded data is served when reloading fails.
+        """
+        data = utils.get_data()
+        version = utils.INGEST_STATUS['version']
+        del utils.CACHE[0]
+        main.app.config.update({
+            'DATA_CSV': TEST_INVALID_DATA_CSV,
+            'INGEST_POLICY': 'fail',
+        })
+        try:
+            self.assertIs(utils.get_data(), data)
+            self.assertIs(utils.get_data(), data)
+        finally:
+            del main.app.config['INGEST_POLICY']
+        self.assertEqual(
+            utils.INGEST_STATUS['error'], 'Invalid user_id in line 2'
+        )
+        self.assertEqual(utils.INGEST_STATUS['serving'], version)
+        self.assertIn(0, utils.CACHE)
+
+    def test_get_groups(self):
+        """
+        Test reading group definitions from XML and config.
+        """
+        main.app.config.update({
+            'DATA_XML': TEST_DATA_XML,
+            'GROUPS': {'qa': {'name': 'Testers', 'users': ['11']}},
+        })
+        try:
+            groups = utils.get_groups()
+        finally:
+            del main.app.config['GROUPS']
+        self.assertEqual(groups, {
+            'dev': {'name': u'Developers', 'users': [10, 141]},
+            'qa': {'name': u'Testers', 'users': [11]},
+        })
+
+    def test_get_groups_invalid(self):
+        """
+        Test invalid group definitions in XML are skipped.
+        """
+        directory = tempfile.mkdtemp()
+        xml_path = os.path.join(directory, 'users.xml')
+        with open(xml_path, 'w') as xml_file:
+            xml_file.write(
+                '<intranet><groups>'
+                '<group><name>No id</name><member>10</member></group>'
+                '<group id="dev"><member>10</member><member>x</member>'
+                '<member /></group>'
+                '</groups></intranet>'
+            )
+        main.app.config.update({'DATA_XML': xml_path})
+        try:
+            groups = utils.get_groups()
+        finally:
+            main.app.config.update({'DATA_XML': TEST_DATA_XML})
+            shutil.rmtree(directory)
+        self.assertEqual(groups, {
+            'dev': {'name': u'dev', 'users': [10]},
+        })
+
+    def test_derived(self):
+        """
+        Test derived results are recomputed only when data is reloaded.
+        """
+        summaries = utils.get_summaries()
+        self.assertIs(utils.get_summaries(), summaries)
+        self.assertEqual(
+            summaries[10], utils.summarize_by_weekday(utils.get_data()[10])
+        )
+        utils.CACHE.pop(0)
+        self.assertIsNot(utils.get_summaries(), summaries)
+
+    def test_get_quantile_rows(self):
+        """
+        Test quantile rows are computed once per data load.
+        """
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        rows = utils.get_quantile_rows()
+        self.assertIs(utils.get_quantile_rows(), rows)
+        self.assertEqual(
+            rows[10], utils.quantile_rows(utils.get_sketches()[10])
+        )
+        self.assertEqual(
+            utils.get_group_quantile_rows()['dev'],
+            utils.quantile_rows(utils.get_group_sketches()['dev'])
+        )
+        utils.CACHE.pop(0)
+        self.assertIsNot(utils.get_quantile_rows(), rows)
+
+    def test_merge_summaries(self):
+        """
+        Test adding up weekday summaries.
+        """
+        data = utils.get_data()
+        result = utils.merge_summaries([
+            utils.summarize_by_weekday(data[10]),
+            utils.summarize_by_weekday(data[11]),
+        ])
+        self.assertEqual(result[1], {
+            'count': 2, 'presence': 46611, 'start': 68335, 'end': 114946
+        })
+
     def test_get_data_cache(self):
         data = utils.get_data()
         self.assertDictEqual(data, utils.CACHE[0]['data'])
@@ -270,6 +690,588 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertDictEqual(data, utils.CACHE[0]['data'])
 
 
+class PresenceAnalyzerBenchmarkTestCase(unittest.TestCase):
+    """
+    Benchmark suite tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        utils.CACHE = {}
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+        utils.CACHE = {}
+
+    def test_generate_data(self):
+        """
+        Test generating synthetic data files.
+        """
+        csv_path, xml_path = benchmark.generate_data(
+            self.directory, users=3, years=1
+        )
+        self.assertTrue(os.path.exists(xml_path))
+        main.app.config.update({'DATA_CSV': csv_path})
+        data = utils.get_data()
+        self.assertItemsEqual(data.keys(), [1, 2, 3])
+        self.assertEqual(len(data[1]), 261)
+        for entry in data[1].itervalues():
+            self.assertLess(entry['start'], entry['end'])
+
+    def test_run_benchmarks(self):
+        """
+        Test running benchmarks against generated data.
+        """
+        csv_path, xml_path = benchmark.generate_data(
+            self.directory, users=2, years=1
+        )
+        results = benchmark.run_benchmarks(csv_path, xml_path, repeat=2)
+        self.assertEqual(results['get_data_cold']['repeat'], 2)
+        self.assertIn('get_data_xml', results)
+        self.assertIn('group_by_weekday', results)
+        self.assertIn('view:presence_weekday_view', results)
+        self.assertIn('view:template_handler', results)
+        self.assertIn('mean', results['view:presence_weekday_view'])
+        self.assertIn('mean', results['view:avatar_view'])
+
+    def test_measure_startup(self):
+        """
+        Test measuring startup in a fresh interpreter.
+        """
+        csv_path, xml_path = benchmark.generate_data(
+            self.directory, users=2, years=1
+        )
+        result = benchmark.measure_startup(
+            csv_path, xml_path, 1, warm_up=True
+        )
+        self.assertItemsEqual(
+            result.keys(), ['import', 'warm_up', 'first_response', 'total']
+        )
+        self.assertGreater(result['total'], result['import'])
+
+    def test_compare(self):
+        """
+        Test comparing two benchmark reports.
+        """
+        old = {'results': {'a': {'mean': 2.0}, 'b': {'error': 'x'}}}
+        new = {'results': {'a': {'mean': 1.0}, 'b': {'mean': 1.0}}}
+        self.assertEqual(benchmark.compare(old, new), {'a': 0.5})
+
+
+class PresenceAnalyzerLoadTestCase(unittest.TestCase):
+    """
+    Load generator tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.CACHE = {}
+
+    def test_percentile(self):
+        """
+        Test nearest-rank percentile.
+        """
+        values = range(1, 101)
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 95), 95)
+        self.assertEqual(loadtest.percentile(values, 100), 100)
+        self.assertEqual(loadtest.percentile([3], 99), 3)
+        self.assertEqual(loadtest.percentile([], 50), 0)
+
+    def test_parse_mix(self):
+        """
+        Test parsing request mix.
+        """
+        self.assertEqual(
+            loadtest.parse_mix(['/api/v2/users', '/api/v1/x/{user_id}=3']),
+            (('/api/v2/users', 1), ('/api/v1/x/{user_id}', 3))
+        )
+
+    def test_run_load(self):
+        """
+        Test running in-process load.
+        """
+        result = loadtest.run_load(
+            loadtest.wsgi_sender(main.app),
+            (('/api/v1/presence_weekday/{user_id}', 1),),
+            [10, 11],
+            concurrency=3,
+            requests=20,
+        )
+        self.assertEqual(result['requests'], 20)
+        self.assertEqual(result['errors'], 0)
+        self.assertLessEqual(result['p50'], result['p95'])
+        self.assertLessEqual(result['p95'], result['p99'])
+        self.assertGreater(result['rps'], 0)
+
+
+class PresenceAnalyzerPreforkTestCase(unittest.TestCase):
+    """
+    Pre-fork server tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        utils.CACHE = {}
+
+    def test_data_files_mtime(self):
+        """
+        Test reading modification times of data files.
+        """
+        self.assertEqual(
+            prefork.data_files_mtime(main.app),
+            (os.stat(TEST_DATA_CSV).st_mtime, os.stat(TEST_DATA_XML).st_mtime)
+        )
+
+    def test_preload_data(self):
+        """
+        Test data loaded before serving is reused until reload.
+        """
+        data = utils.get_data()
+        prefork.preload_data()
+        self.assertIs(utils.get_data(), data)
+        prefork.preload_data(reload=True)
+        self.assertIsNot(utils.get_data(), data)
+
+    def test_preload_data_failure(self):
+        """
+        Test loaded data is kept when it cannot be reloaded.
+        """
+        data = utils.get_data()
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV + '.missing'})
+        with self.assertRaises(IOError):
+            prefork.preload_data(reload=True)
+        self.assertIs(utils.get_data(), data)
+
+        main.app.config.update({
+            'DATA_CSV': TEST_INVALID_DATA_CSV,
+            'INGEST_POLICY': 'fail',
+        })
+        try:
+            prefork.preload_data(reload=True)
+        finally:
+            del main.app.config['INGEST_POLICY']
+        self.assertIs(utils.get_data(), data)
+
+    def test_sync_users(self):
+        """
+        Test users are synchronized by the master in given intervals.
+        """
+        class FakeSync(object):
+            interval = 3600
+            calls = []
+
+            def sync(self):
+                self.calls.append(1)
+                return True
+
+        server = prefork.PreforkServer(
+            main.app, host='127.0.0.1', port=0, users_sync=FakeSync()
+        )
+        try:
+            self.assertTrue(server.sync_users())
+            self.assertFalse(server.sync_users())
+            self.assertEqual(FakeSync.calls, [1])
+        finally:
+            server.server.server_close()
+
+    def test_reload_failure(self):
+        """
+        Test old workers are kept when data cannot be reloaded.
+        """
+        server = prefork.PreforkServer(
+            main.app, host='127.0.0.1', port=0, workers=2, watch=False
+        )
+        try:
+            server.children = set([12345, 12346])
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV + '.missing'})
+            server.reload()
+            self.assertEqual(server.children, set([12345, 12346]))
+            self.assertEqual(server.retiring, set())
+        finally:
+            server.server.server_close()
+
+    def test_idle_worker(self):
+        """
+        Test idle workers wait for connections without using CPU.
+        """
+        class Server(prefork.PreforkServer):
+            check_interval = 0.1
+
+        server = Server(main.app, host='127.0.0.1', port=0, workers=1)
+        try:
+            calls = 0
+            started = time.time()
+            cpu_started = time.clock()
+            while time.time() - started < 0.5:
+                server.server.handle_request()
+                calls += 1
+            cpu_time = time.clock() - cpu_started
+        finally:
+            server.server.server_close()
+        self.assertLessEqual(calls, 6)
+        self.assertLess(cpu_time, 0.1)
+
+    def test_serve(self):
+        """
+        Test serving requests from forked workers.
+        """
+        server = prefork.PreforkServer(
+            main.app, host='127.0.0.1', port=0, workers=2, watch=False
+        )
+        port = server.server.server_address[1]
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)  # pylint: disable-msg=W0212
+        server.server.server_close()
+        try:
+            for _ in xrange(50):
+                try:
+                    connection = httplib.HTTPConnection('127.0.0.1', port)
+                    connection.request('GET', '/api/v1/presence_weekday/10')
+                    response = connection.getresponse()
+                    break
+                except IOError:
+                    time.sleep(0.1)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(json.loads(response.read())[2], [u'Tue', 30047])
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+
+class UsersExportHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for the intranet users export supporting conditional GET.
+    """
+    etag = '"v1"'
+    content = open(TEST_DATA_XML).read()
+    requests = []
+
+    def do_GET(self):  # pylint: disable=C0103
+        """
+        Serves users XML or 304 when client has the current version.
+        """
+        self.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Type', 'application/xml')
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, *args):
+        """
+        Keeps test output clean.
+        """
+        pass
+
+
+class PresenceAnalyzerUsersSyncTestCase(unittest.TestCase):
+    """
+    Users XML synchronization tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        UsersExportHandler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), UsersExportHandler
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/users.xml'.format(
+            self.server.server_address[1]
+        )
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'users.xml')
+        utils.CACHE = {}
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_sync_users(self):
+        """
+        Test downloading users XML with conditional GET.
+        """
+        utils.CACHE[utils.USERS_CACHE_KEY] = {'data': [], 'time': 0}
+        self.assertTrue(users_sync.sync_users(self.url, self.path))
+        self.assertNotIn(utils.USERS_CACHE_KEY, utils.CACHE)
+        with open(self.path) as users_file:
+            self.assertEqual(users_file.read(), UsersExportHandler.content)
+        self.assertEqual(os.listdir(self.directory).count('users.xml'), 1)
+
+        self.assertFalse(users_sync.sync_users(self.url, self.path))
+        self.assertEqual(
+            UsersExportHandler.requests[1].get('if-none-match'), '"v1"'
+        )
+
+    def test_sync_users_missing_file(self):
+        """
+        Test validators are not sent when local file is missing.
+        """
+        self.assertTrue(users_sync.sync_users(self.url, self.path))
+        os.unlink(self.path)
+        self.assertTrue(users_sync.sync_users(self.url, self.path))
+        self.assertNotIn('if-none-match', UsersExportHandler.requests[1])
+
+    def test_sync_fallback(self):
+        """
+        Test local file is kept when export is not available.
+        """
+        with open(self.path, 'w') as users_file:
+            users_file.write('local')
+        main.app.config.update({'USERS': self.url, 'DATA_XML': self.path})
+        content = UsersExportHandler.content
+        UsersExportHandler.content = '<broken'
+        try:
+            self.assertFalse(users_sync.UsersSync(main.app, 1).sync())
+        finally:
+            UsersExportHandler.content = content
+        with open(self.path) as users_file:
+            self.assertEqual(users_file.read(), 'local')
+        main.app.config.update({'USERS': 'http://127.0.0.1:1/'})
+        self.assertFalse(users_sync.UsersSync(main.app, 1).sync())
+
+    def test_sync_thread_survives_errors(self):
+        """
+        Test unexpected errors do not stop scheduled synchronization.
+        """
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        listener.settimeout(5)
+
+        def close_connections():
+            for _ in xrange(2):
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    return
+                connection.recv(1024)
+                connection.close()
+
+        closer = threading.Thread(target=close_connections)
+        closer.daemon = True
+        closer.start()
+        main.app.config.update({
+            'USERS': 'http://127.0.0.1:{}/'.format(listener.getsockname()[1]),
+            'DATA_XML': self.path,
+        })
+        thread = users_sync.UsersSync(main.app, 0.05)
+        thread.start()
+        try:
+            closer.join(10)
+            self.assertTrue(thread.is_alive())
+        finally:
+            thread.stop()
+            thread.join()
+            listener.close()
+
+
+class PresenceAnalyzerAvatarsTestCase(unittest.TestCase):
+    """
+    Avatar cache tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.avatar = open(views.AVATAR_PLACEHOLDER, 'rb').read()
+        self.source = os.path.join(self.directory, 'source.png')
+        with open(self.source, 'wb') as source:
+            source.write(self.avatar)
+        main.app.config.update({
+            'AVATAR_CACHE_DIR': os.path.join(self.directory, 'cache'),
+        })
+        utils.CACHE = {
+            utils.USERS_CACHE_KEY: {
+                'data': [('141', {'avatar': 'file://' + self.source})],
+                'time': time.time() + 600,
+            },
+        }
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+        utils.CACHE = {}
+
+    def test_avatar_view(self):
+        """
+        Test serving placeholder and then cached avatar.
+        """
+        resp = self.client.get('/api/v2/avatar/141')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'image/png')
+        self.assertEqual(resp.cache_control.max_age, 0)
+        for _ in xrange(50):
+            if avatars.get_avatar_cache(main.app).get(141):
+                break
+            time.sleep(0.05)
+
+        resp = self.client.get('/api/v2/avatar/141')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, self.avatar)
+        self.assertEqual(
+            resp.cache_control.max_age, views.AVATAR_CACHE_TIMEOUT
+        )
+
+    def test_avatar_view_unknown_user(self):
+        """
+        Test placeholder is served for unknown users.
+        """
+        resp = self.client.get('/api/v2/avatar/999')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'image/png')
+        self.assertEqual(avatars.get_avatar_cache(main.app).pending, set())
+
+    def test_avatar_view_users_error(self):
+        """
+        Test placeholder is served when users XML cannot be read.
+        """
+        utils.CACHE = {}
+        main.app.config.update({'DATA_XML': self.source + '.missing'})
+        try:
+            resp = self.client.get('/api/v2/avatar/141')
+        finally:
+            main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'image/png')
+        self.assertEqual(resp.cache_control.max_age, 0)
+
+    def test_default_cache_dir(self):
+        """
+        Test avatars are kept in the instance folder by default.
+        """
+        instance_path = main.app.instance_path
+        main.app.instance_path = self.directory
+        del main.app.config['AVATAR_CACHE_DIR']
+        try:
+            cache = avatars.get_avatar_cache(main.app)
+        finally:
+            main.app.instance_path = instance_path
+        self.assertEqual(
+            cache.directory, os.path.join(self.directory, 'avatars')
+        )
+        self.assertTrue(os.path.isdir(cache.directory))
+
+    def test_lru_eviction(self):
+        """
+        Test least recently used avatars are evicted above size limit.
+        """
+        cache = avatars.AvatarCache(os.path.join(self.directory, 'lru'), 25)
+        cache.store(1, 'a' * 10)
+        os.utime(cache.path(1), (1, 1))
+        cache.store(2, 'b' * 10)
+        os.utime(cache.path(2), (2, 2))
+        self.assertIsNotNone(cache.get(1))
+        cache.store(3, 'c' * 10)
+        self.assertIsNotNone(cache.get(1))
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(3))
+
+    def test_fetch_not_image(self):
+        """
+        Test responses which are not images are not cached.
+        """
+        with open(self.source, 'w') as source:
+            source.write('<html>')
+        cache = avatars.AvatarCache(os.path.join(self.directory, 'x'), 100)
+        cache.fetch(1, 'file://' + self.source)
+        self.assertIsNone(cache.get(1))
+
+    def test_fetch_failure_remembered(self):
+        """
+        Test failed avatars are not fetched again until retry time passes.
+        """
+        missing = 'file://' + os.path.join(self.directory, 'missing.png')
+        cache = avatars.AvatarCache(
+            os.path.join(self.directory, 'x'), len(self.avatar)
+        )
+        cache.fetch(1, missing)
+        self.assertIn(1, cache.failures)
+        self.assertIsNone(cache.fetch_async(1, missing))
+        self.assertEqual(cache.pending, set())
+
+        cache.retry_after = 0
+        cache.fetch_async(1, 'file://' + self.source).join()
+        self.assertIsNotNone(cache.get(1))
+        self.assertNotIn(1, cache.failures)
+
+
+class PresenceAnalyzerSketchesTestCase(unittest.TestCase):
+    """
+    Quantile sketches tests.
+    """
+
+    def test_quantile(self):
+        """
+        Test approximating quantiles.
+        """
+        sketch = sketches.QuantileSketch(resolution=10)
+        self.assertEqual(sketch.quantile(0.5), 0)
+        for value in range(100):
+            sketch.add(value)
+        self.assertEqual(len(sketch), 100)
+        self.assertEqual(sketch.quantile(0.5), 45)
+        self.assertEqual(sketch.quantile(0.9), 85)
+        self.assertEqual(sketch.quantile(0), 5)
+        self.assertEqual(sketch.quantile(1), 95)
+
+        sketch.add(1000)
+        self.assertEqual(sketch.quantile(1), 1005)
+        self.assertEqual(sketch.index()[1][-1], 101)
+
+    def test_merge(self):
+        """
+        Test merging sketches.
+        """
+        first = sketches.QuantileSketch()
+        second = sketches.QuantileSketch()
+        for value in (60, 120, 180):
+            first.add(value)
+        for value in (120, 600):
+            second.add(value)
+        first.merge(second)
+        self.assertEqual(len(first), 5)
+        self.assertEqual(first.counts, {1: 1, 2: 2, 3: 1, 10: 1})
+        self.assertEqual(first.quantile(0.5), 150)
+        with self.assertRaises(ValueError):
+            first.merge(sketches.QuantileSketch(resolution=1))
+
+
 def suite():
     """
     Default test suite.
@@ -277,6 +1279,12 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerBenchmarkTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerLoadTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerPreforkTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerUsersSyncTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerAvatarsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerSketchesTestCase))
     return suite
 
 
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Synchronization of users XML file with the intranet export.
+"""
+
+import os
+import json
+import urllib2
+import threading
+
+from presence_analyzer import utils
+from presence_analyzer.utils import atomic_write
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+def _meta_path(path):
+    """
+    Returns path of file keeping validators of the last download.
+    """
+    return path + '.meta'
+
+
+def read_meta(path):
+    """
+    Reads ETag and Last-Modified of the last download of given file.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(_meta_path(path)) as meta_file:
+            return json.load(meta_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def sync_users(url, path, timeout=10):
+    """
+    Downloads users XML to given path unless it has not changed.
+
+    Uses conditional GET with validators of the previous download. Content
+    is checked to be well-formed XML before it replaces the local file.
+    Returns True when the local file was updated.
+    """
+    from lxml import etree
+    meta = read_meta(path)
+    request = urllib2.Request(url)
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as exc:
+        if exc.code == 304:
+            log.debug('Users XML not modified')
+            return False
+        raise
+
+    content = response.read()
+    etree.fromstring(content)
+    atomic_write(path, content)
+    atomic_write(_meta_path(path), json.dumps({
+        'etag': response.info().getheader('ETag'),
+        'last_modified': response.info().getheader('Last-Modified'),
+    }))
+    utils.CACHE.pop(utils.USERS_CACHE_KEY, None)
+    utils.CACHE.pop(utils.GROUPS_CACHE_KEY, None)
+    log.info('Users XML updated from %s', url)
+    return True
+
+
+class UsersSync(threading.Thread):
+    """
+    Background thread synchronizing users XML in given intervals.
+
+    When the export cannot be fetched the local file is kept.
+    """
+
+    def __init__(self, app, interval):
+        super(UsersSync, self).__init__(name='UsersSync')
+        self.daemon = True
+        self.app = app
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sync()
+            self.stopped.wait(self.interval)
+
+    def sync(self):
+        """
+        Synchronizes once, falling back to the local file on errors.
+        """
+        from lxml import etree
+        try:
+            return sync_users(self.app.config['USERS'],
+                              self.app.config['DATA_XML'])
+        except (IOError, etree.XMLSyntaxError) as exc:
+            log.warning('Users XML sync failed, using local file: %s', exc)
+            return False
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Users XML sync failed, using local file')
+            return False
+
+    def stop(self):
+        """
+        Stops the thread after current synchronization.
+        """
+        self.stopped.set()
+
+
+def make_users_sync(app):
+    """
+    Returns users synchronization if it is configured, without starting it.
+    """
+    interval = app.config.get('USERS_SYNC_INTERVAL')
+    if not interval or not app.config.get('USERS'):
+        return None
+    return UsersSync(app, interval)
+
+
+def start_users_sync(app):
+    """
+    Starts background users synchronization if it is configured.
+    """
+    thread = make_users_sync(app)
+    if thread is not None:
+        thread.start()
+    return thread
@@ -3,14 +3,19 @@
 Helper functions used in views.
 """
 
+import os
 import csv
 import locale
+import calendar
+import hashlib
+import tempfile
 from json import dumps
+from cStringIO import StringIO
 from functools import wraps
 from datetime import datetime
-from lxml import etree
 from flask import Response
 from presence_analyzer.main import app
+from presence_analyzer.sketches import QuantileSketch
 from time import time as cur_time
 from threading import Lock
 
@@ -20,6 +25,37 @@ log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 CACHE = {}
 LOCKER = Lock()
 
+# Cache key of users data parsed from XML file.
+USERS_CACHE_KEY = 'users_xml'
+
+# Cache key of group definitions.
+GROUPS_CACHE_KEY = 'groups'
+
+# Id of implicit group of all users.
+ALL_GROUP = 'all'
+
+# What to do with CSV rows which cannot be parsed.
+INGEST_POLICIES = ('skip', 'quarantine', 'fail')
+
+# Cache key of the last successfully loaded presence data.
+LAST_DATA_CACHE_KEY = 'last_data'
+
+# Report of the last CSV load.
+INGEST_STATUS = {}
+
+
+class IngestError(ValueError):
+    """
+    Raised when CSV row is invalid and ingest policy is 'fail'.
+    """
+
+    def __init__(self, line, kind):
+        super(IngestError, self).__init__(
+            'Invalid {} in line {}'.format(kind, line)
+        )
+        self.line = line
+        self.kind = kind
+
 
 def locker(fun):
     """
@@ -48,10 +84,50 @@ def cache(duration, key):
     return _cache
 
 
+def derived(key, *sources):
+    """
+    Caches result computed from results of source functions.
+
+    Result is recomputed only when any of sources returns a different
+    object, e.g. after get_data() reloaded the CSV file.
+    """
+    def _derived(fun):
+        @wraps(fun)
+        def __derived():
+            values = tuple(source() for source in sources)
+            entry = CACHE.get(key)
+            if (entry is None or len(entry['sources']) != len(values) or
+                    any(a is not b for a, b in zip(entry['sources'], values))):
+                entry = CACHE[key] = {
+                    'data': fun(*values),
+                    'sources': values,
+                }
+            return entry['data']
+        return __derived
+    return _derived
+
+
+def atomic_write(path, content):
+    """
+    Writes content to a temporary file and renames it over given path.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as temp_file:
+            temp_file.write(content)
+        os.rename(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+@cache(600, USERS_CACHE_KEY)
 def get_data_xml():
     """
     Parses data from XML file (server and users info).
     """
+    from lxml import etree
     xml_file = etree.parse(app.config['DATA_XML']).getroot()
     server = {
         'host': xml_file.findtext('.//host'),
@@ -85,6 +161,54 @@ def get_data_xml():
     return users_xml
 
 
+@cache(600, GROUPS_CACHE_KEY)
+def get_groups():
+    """
+    Returns group definitions from XML file and GROUPS config.
+
+    Groups are defined in XML file as:
+    <group id="dev"><name>Developers</name><member>141</member></group>
+    and in config as:
+    GROUPS = {'dev': {'name': 'Developers', 'users': [141]}}
+
+    It creates structure like this:
+    groups = {
+        'dev': {'name': u'Developers', 'users': [141]},
+    }
+    """
+    from lxml import etree
+    groups = {}
+    try:
+        xml_file = etree.parse(app.config['DATA_XML']).getroot()
+    except (IOError, etree.XMLSyntaxError):
+        log.warning('Cannot read groups from XML file', exc_info=True)
+    else:
+        for group in xml_file.findall('.//group'):
+            group_id = group.get('id')
+            if not group_id:
+                log.warning('Skipping group without id in line %s',
+                            group.sourceline)
+                continue
+            users = []
+            for member in group.iter('member'):
+                try:
+                    users.append(int(member.text))
+                except (TypeError, ValueError):
+                    log.warning('Skipping invalid member %r of group %s',
+                                member.text, group_id)
+            groups[group_id] = {
+                'name': unicode(group.findtext('name') or group_id),
+                'users': users,
+            }
+
+    for group_id, group in app.config.get('GROUPS', {}).iteritems():
+        groups[group_id] = {
+            'name': unicode(group.get('name', group_id)),
+            'users': [int(user_id) for user_id in group['users']],
+        }
+    return groups
+
+
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
@@ -115,26 +239,162 @@ def get_data():
             },
         }
     }
+
+    When the file cannot be loaded, the last successfully loaded data
+    is returned instead, if there is any.
+    """
+    policy = app.config.get('INGEST_POLICY', 'skip')
+    try:
+        data, status = ingest_csv(
+            app.config['DATA_CSV'],
+            policy=policy,
+            quarantine=app.config.get('INGEST_QUARANTINE'),
+        )
+    except IngestError as exc:
+        last = CACHE.get(LAST_DATA_CACHE_KEY)
+        INGEST_STATUS.clear()
+        INGEST_STATUS.update({
+            'source': app.config['DATA_CSV'],
+            'policy': policy,
+            'error': str(exc),
+            'serving': last['version'] if last else None,
+        })
+        if last is None:
+            raise
+        log.error('Loading presence data failed, serving version %s: %s',
+                  last['version'], exc)
+        return last['data']
+    CACHE[LAST_DATA_CACHE_KEY] = {'data': data, 'version': status['version']}
+    INGEST_STATUS.clear()
+    INGEST_STATUS.update(status)
+    return data
+
+
+def parse_row(row):
+    """
+    Parses CSV row into (user_id, date, start, end).
+
+    Raises ValueError with kind of error as its message.
+    """
+    if len(row) != 4:
+        raise ValueError('columns')
+    parsers = (
+        ('user_id', int),
+        ('date', lambda value: datetime.strptime(value, '%Y-%m-%d').date()),
+        ('start', lambda value: datetime.strptime(value, '%H:%M:%S').time()),
+        ('end', lambda value: datetime.strptime(value, '%H:%M:%S').time()),
+    )
+    values = []
+    for (kind, parser), value in zip(parsers, row):
+        try:
+            values.append(parser(value))
+        except (ValueError, TypeError):
+            raise ValueError(kind)
+    if values[3] < values[2]:
+        raise ValueError('interval')
+    return tuple(values)
+
+
+def ingest_csv(path, policy='skip', quarantine=None):
     """
+    Loads presence CSV file applying given policy to invalid rows.
+
+    Policies:
+     - 'skip' ignores invalid rows,
+     - 'quarantine' also writes them with line number and kind of error to
+       a side file (path + '.rejected' by default),
+     - 'fail' raises IngestError.
+
+    Empty lines and header or footer lines (first or last line which does
+    not start with user_id) are skipped before the policy is applied.
+
+    Returns data grouped by user_id (see get_data) and ingest report with
+    row counts, rejects per kind of error, load duration and version of the
+    dataset (hash of file content).
+    """
+    if policy not in INGEST_POLICIES:
+        raise ValueError('Unknown ingest policy: {}'.format(policy))
+    started = cur_time()
+    checksum = hashlib.sha1()
+    errors = {}
+    rejected = []
+    rows = 0
+    skipped = 0
     data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
 
+    def lines(csvfile):
+        for line in csvfile:
+            checksum.update(line)
+            yield line
+
+    with open(path, 'r') as csvfile:
+        presence_reader = csv.reader(lines(csvfile), delimiter=',')
+        for i, row, edge in _mark_edges(presence_reader):
+            if not row or (edge and not row[0].strip().isdigit()):
+                # ignore empty, header and footer lines
+                skipped += 1
+                continue
+            rows += 1
             try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
+                user_id, date, start, end = parse_row(row)
+            except ValueError as exc:
+                kind = str(exc)
+                log.debug('Problem with line %d: %s', i, kind)
+                if policy == 'fail':
+                    raise IngestError(i, kind)
+                errors[kind] = errors.get(kind, 0) + 1
+                if policy == 'quarantine':
+                    rejected.append(row + [str(i), kind])
+                continue
 
             data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
 
-    return data
+    if policy == 'quarantine':
+        _write_rejected(quarantine or path + '.rejected', rejected)
+
+    return data, {
+        'source': path,
+        'policy': policy,
+        'rows': rows,
+        'skipped': skipped,
+        'accepted': rows - sum(errors.values()),
+        'rejected': sum(errors.values()),
+        'errors': errors,
+        'duration': cur_time() - started,
+        'version': checksum.hexdigest()[:12],
+        'loaded_at': datetime.now().isoformat(),
+    }
+
+
+def _mark_edges(rows):
+    """
+    Yields (line number, row, whether it is the first or the last line).
+    """
+    previous = None
+    for i, row in enumerate(rows, 1):
+        if previous is not None:
+            yield previous + (previous[0] == 1,)
+        previous = (i, row)
+    if previous is not None:
+        yield previous + (True,)
+
+
+def csv_line(values):
+    """
+    Formats values as a single CSV line.
+    """
+    output = StringIO()
+    csv.writer(output, lineterminator='\n').writerow(values)
+    return output.getvalue()
+
+
+def _write_rejected(path, rows):
+    """
+    Writes rejected CSV rows to quarantine file.
+    """
+    output = StringIO()
+    csv.writer(output, lineterminator='\n').writerows(rows)
+    atomic_write(path, output.getvalue())
 
 
 def group_by_weekday(items):
@@ -162,6 +422,221 @@ def group_start_end_by_weekday(items):
     return result
 
 
+def summarize_by_weekday(items):
+    """
+    Sums presence entries by weekday in a single pass.
+
+    For every weekday returns number of entries and sums (in seconds) of
+    presence intervals, start times and end times.
+    """
+    result = {
+        i: {'count': 0, 'presence': 0, 'start': 0, 'end': 0}
+        for i in range(7)
+    }
+    for date, entry in items.iteritems():
+        start = seconds_since_midnight(entry['start'])
+        end = seconds_since_midnight(entry['end'])
+        day = result[date.weekday()]
+        day['count'] += 1
+        day['presence'] += end - start
+        day['start'] += start
+        day['end'] += end
+    return result
+
+
+def merge_summaries(summaries):
+    """
+    Adds up weekday summaries of many users.
+    """
+    result = {
+        i: {'count': 0, 'presence': 0, 'start': 0, 'end': 0}
+        for i in range(7)
+    }
+    for summary in summaries:
+        for weekday, day in summary.iteritems():
+            for field, value in day.iteritems():
+                result[weekday][field] += value
+    return result
+
+
+@derived('summaries', get_data)
+def get_summaries(data):
+    """
+    Returns weekday summaries of all users, computed once per data load.
+    """
+    return {
+        user_id: summarize_by_weekday(items)
+        for user_id, items in data.iteritems()
+    }
+
+
+def group_members(groups, user_ids):
+    """
+    Returns members of every group limited to given users.
+
+    Group ALL_GROUP contains all given users.
+    """
+    user_ids = set(user_ids)
+    members = {
+        group_id: user_ids.intersection(group['users'])
+        for group_id, group in groups.iteritems()
+    }
+    members.setdefault(ALL_GROUP, user_ids)
+    return members
+
+
+@derived('group_summaries', get_summaries, get_groups)
+def get_group_summaries(summaries, groups):
+    """
+    Returns weekday summaries of all groups, computed once per data load.
+    """
+    return {
+        group_id: merge_summaries(summaries[user_id] for user_id in users)
+        for group_id, users in group_members(groups, summaries).iteritems()
+    }
+
+
+def sketch_by_weekday(items, resolution=60):
+    """
+    Builds quantile sketches of presence, start and end times by weekday.
+    """
+    result = {
+        i: {
+            'presence': QuantileSketch(resolution),
+            'start': QuantileSketch(resolution),
+            'end': QuantileSketch(resolution),
+        }
+        for i in range(7)
+    }
+    for date, entry in items.iteritems():
+        start = seconds_since_midnight(entry['start'])
+        end = seconds_since_midnight(entry['end'])
+        day = result[date.weekday()]
+        day['presence'].add(end - start)
+        day['start'].add(start)
+        day['end'].add(end)
+    return result
+
+
+def merge_sketches(sketches, resolution=60):
+    """
+    Merges weekday sketches of many users.
+    """
+    result = sketch_by_weekday({}, resolution)
+    for sketch in sketches:
+        for weekday, day in sketch.iteritems():
+            for field, value in day.iteritems():
+                result[weekday][field].merge(value)
+    return result
+
+
+@derived('sketches', get_data)
+def get_sketches(data):
+    """
+    Returns weekday quantile sketches of all users, built once per data load.
+
+    Sketches are not updated incrementally: every load re-reads the whole
+    CSV file, so they are rebuilt from the loaded data.
+    """
+    resolution = app.config.get('QUANTILE_RESOLUTION', 60)
+    return {
+        user_id: sketch_by_weekday(items, resolution)
+        for user_id, items in data.iteritems()
+    }
+
+
+@derived('group_sketches', get_sketches, get_groups)
+def get_group_sketches(sketches, groups):
+    """
+    Returns weekday quantile sketches of all groups, merged from users.
+    """
+    resolution = app.config.get('QUANTILE_RESOLUTION', 60)
+    return {
+        group_id: merge_sketches(
+            (sketches[user_id] for user_id in users), resolution
+        )
+        for group_id, users in group_members(groups, sketches).iteritems()
+    }
+
+
+@derived('quantile_rows', get_sketches)
+def get_quantile_rows(sketches):
+    """
+    Returns quantile rows (see quantile_rows) of all users.
+    """
+    return {
+        user_id: quantile_rows(sketch)
+        for user_id, sketch in sketches.iteritems()
+    }
+
+
+@derived('group_quantile_rows', get_group_sketches)
+def get_group_quantile_rows(sketches):
+    """
+    Returns quantile rows (see quantile_rows) of all groups.
+    """
+    return {
+        group_id: quantile_rows(sketch)
+        for group_id, sketch in sketches.iteritems()
+    }
+
+
+def presence_weekday_rows(summary):
+    """
+    Returns total presence time by weekday from weekday summary.
+    """
+    return [('Weekday', 'Presence (s)')] + [
+        (calendar.day_abbr[weekday], day['presence'])
+        for weekday, day in sorted(summary.items())
+    ]
+
+
+def mean_time_weekday_rows(summary):
+    """
+    Returns mean presence time by weekday from weekday summary.
+    """
+    return [
+        (calendar.day_abbr[weekday], _mean_of_sum(day['presence'], day))
+        for weekday, day in sorted(summary.items())
+    ]
+
+
+def presence_start_end_rows(summary):
+    """
+    Returns mean start and end time by weekday from weekday summary.
+    """
+    return [
+        [
+            calendar.day_abbr[weekday],
+            _mean_of_sum(day['start'], day),
+            _mean_of_sum(day['end'], day),
+        ]
+        for weekday, day in sorted(summary.items())
+    ]
+
+
+def quantile_rows(sketches):
+    """
+    Returns median and 90th percentile of presence time, start and end
+    by weekday from weekday sketches.
+    """
+    return [
+        [calendar.day_abbr[weekday]] + [
+            day[field].quantile(fraction)
+            for field in ('presence', 'start', 'end')
+            for fraction in (0.5, 0.9)
+        ]
+        for weekday, day in sorted(sketches.items())
+    ]
+
+
+def _mean_of_sum(total, day):
+    """
+    Calculates mean from sum of day entries. Returns zero for no entries.
+    """
+    return float(total) / day['count'] if day['count'] else 0
+
+
 def seconds_since_midnight(time):
     """
     Calculates amount of seconds since midnight.
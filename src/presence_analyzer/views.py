@@ -3,26 +3,143 @@
 Defines views.
 """
 
+import os
 import calendar
 from presence_analyzer.main import app
-from flask import redirect
-from flask.ext.mako import MakoTemplates
-from flask.ext.mako import render_template
+from threading import Lock
+from flask import redirect, send_file, request, Response
 from flask.helpers import make_response
-from mako.exceptions import TopLevelLookupException
 from presence_analyzer.utils import (
     jsonify,
     get_data,
     mean, group_by_weekday,
     seconds_since_midnight,
     group_start_end_by_weekday,
-    get_data_xml
+    get_data_xml,
+    get_groups,
+    get_summaries,
+    get_group_summaries,
+    presence_weekday_rows,
+    mean_time_weekday_rows,
+    presence_start_end_rows,
+    get_quantile_rows,
+    get_group_quantile_rows,
+    csv_line,
+    INGEST_STATUS,
+    IngestError,
+    ALL_GROUP
 )
+from presence_analyzer.avatars import get_avatar_cache, image_mimetype
 
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
-mako = MakoTemplates(app)
+
+TEMPLATES_LOCK = Lock()
+
+# Compiled templates are kept in this subdirectory of the instance folder
+# unless MAKO_MODULE_DIRECTORY is set.
+MAKO_MODULE_SUBDIRECTORY = 'mako'
+
+# Pages rendered once, by (script root, template name).
+RENDERED_PAGES = {}
+
+AVATAR_PLACEHOLDER = os.path.join(
+    app.root_path, 'static', 'img', 'avatar_placeholder.png'
+)
+AVATAR_CACHE_TIMEOUT = 30 * 24 * 3600
+
+# CSV exports: header and function building row from weekday summary.
+EXPORTS = {
+    'presence_weekday': (
+        list(calendar.day_abbr),
+        lambda summary: [
+            total for _, total in presence_weekday_rows(summary)[1:]
+        ],
+    ),
+    'mean_time_weekday': (
+        list(calendar.day_abbr),
+        lambda summary: [
+            mean_time for _, mean_time in mean_time_weekday_rows(summary)
+        ],
+    ),
+    'presence_start_end': (
+        [
+            '{} {}'.format(day, field)
+            for day in calendar.day_abbr for field in ('start', 'end')
+        ],
+        lambda summary: [
+            value
+            for _, start, end in presence_start_end_rows(summary)
+            for value in (start, end)
+        ],
+    ),
+}
+
+
+def init_templates():
+    """
+    Sets up Mako templates, importing Mako on first use.
+    """
+    with TEMPLATES_LOCK:
+        if 'mako' not in app.extensions:
+            from flask.ext.mako import MakoTemplates
+            app.config.setdefault(
+                'MAKO_MODULE_DIRECTORY',
+                os.path.join(app.instance_path, MAKO_MODULE_SUBDIRECTORY)
+            )
+            app.config.setdefault('MAKO_FILESYSTEM_CHECKS', app.debug)
+            MakoTemplates(app)
+
+
+def page_templates():
+    """
+    Returns names of page templates (all except base templates).
+    """
+    return sorted(
+        name[:-len('.html')]
+        for name in os.listdir(os.path.join(app.root_path, 'templates'))
+        if name.endswith('.html') and not name.startswith('base')
+    )
+
+
+PAGE_TEMPLATES = frozenset(page_templates())
+
+
+def render_page(template):
+    """
+    Renders page template once and returns cached result afterwards.
+
+    Pages take no per-request data, so they are rendered again only in
+    debug mode, where templates may change.
+    """
+    key = (request.script_root, template)
+    page = RENDERED_PAGES.get(key)
+    if page is None:
+        from flask.ext.mako import render_template
+        init_templates()
+        page = render_template(template + '.html')
+        if not app.debug:
+            RENDERED_PAGES[key] = page
+    return page
+
+
+def warm_up():
+    """
+    Loads data and renders templates ahead of the first request.
+    """
+    get_data()
+    get_summaries()
+    get_quantile_rows()
+    get_group_summaries()
+    get_group_quantile_rows()
+    try:
+        get_data_xml()
+    except Exception:  # pylint: disable-msg=W0703
+        log.warning('Cannot load users XML', exc_info=True)
+    with app.test_request_context():
+        for template in PAGE_TEMPLATES:
+            render_page(template)
 
 
 @app.route('/')
@@ -38,10 +155,9 @@ def template_handler(template):
     """
     Handles generating templates.
     """
-    try:
-        return render_template(template+'.html')
-    except TopLevelLookupException:
+    if template not in PAGE_TEMPLATES:
         return make_response('This page does not exist', 404)
+    return render_page(template)
 
 
 @app.route('/api/v1/users', methods=['GET'])
@@ -64,6 +180,183 @@ def users_view_xml():
     return get_data_xml()
 
 
+@app.route('/api/v1/ingest_status', methods=['GET'])
+@jsonify
+def ingest_status_view():
+    """
+    Returns report of the last presence data load.
+    """
+    try:
+        get_data()
+    except IngestError:
+        pass
+    return dict(INGEST_STATUS)
+
+
+@app.route('/api/v2/avatar/<int:user_id>', methods=['GET'])
+def avatar_view(user_id):
+    """
+    Serves user avatar from local cache.
+
+    Missing avatars are fetched in background and a placeholder is served
+    in the meantime.
+    """
+    avatars = get_avatar_cache(app)
+    path = avatars.get(user_id)
+    if path is not None:
+        return send_file(path, mimetype=image_mimetype(path),
+                         cache_timeout=AVATAR_CACHE_TIMEOUT)
+
+    try:
+        users = dict(get_data_xml())
+    except Exception:  # pylint: disable-msg=W0703
+        log.warning('Cannot load users XML', exc_info=True)
+        users = {}
+    if str(user_id) in users:
+        avatars.fetch_async(user_id, users[str(user_id)]['avatar'])
+    else:
+        log.debug('User %s not found!', user_id)
+    return send_file(AVATAR_PLACEHOLDER, mimetype='image/png',
+                     cache_timeout=0)
+
+
+@app.route('/api/v1/report/<int:user_id>', methods=['GET'])
+@jsonify
+def report_view(user_id):
+    """
+    Returns data of all per-user views computed in a single pass.
+    """
+    summaries = get_summaries()
+    if user_id not in summaries:
+        log.debug('User %s not found!', user_id)
+        return {
+            'presence_weekday': [],
+            'mean_time_weekday': [],
+            'presence_start_end': [],
+        }
+
+    return {
+        'presence_weekday': presence_weekday_rows(summaries[user_id]),
+        'mean_time_weekday': mean_time_weekday_rows(summaries[user_id]),
+        'presence_start_end': presence_start_end_rows(summaries[user_id]),
+    }
+
+
+@app.route('/api/v1/presence_quantiles/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_quantiles_view(user_id):
+    """
+    Returns median and 90th percentile of presence time, start and end of
+    work of given user grouped by weekday.
+    """
+    rows = get_quantile_rows()
+    if user_id not in rows:
+        log.debug('User %s not found!', user_id)
+        return []
+
+    return rows[user_id]
+
+
+@app.route(
+    '/api/v1/export/<any(presence_weekday, mean_time_weekday, '
+    'presence_start_end):report>.csv',
+    methods=['GET']
+)
+def export_view(report):
+    """
+    Streams given report of all users as CSV, one user per row.
+    """
+    summaries = get_summaries()
+    header, row = EXPORTS[report]
+
+    def generate():
+        yield csv_line(['user_id'] + header)
+        for user_id in sorted(summaries):
+            yield csv_line([user_id] + row(summaries[user_id]))
+
+    return Response(generate(), mimetype='text/csv', headers={
+        'Content-Disposition': 'attachment; filename={}.csv'.format(report),
+    })
+
+
+@app.route('/api/v1/groups', methods=['GET'])
+@jsonify
+def groups_view():
+    """
+    Groups listing.
+    """
+    names = {
+        group_id: group['name']
+        for group_id, group in get_groups().iteritems()
+    }
+    names.setdefault(ALL_GROUP, u'All users')
+    return [
+        {'group_id': group_id, 'name': names[group_id]}
+        for group_id in sorted(names)
+    ]
+
+
+@app.route('/api/v1/group/<string:group_id>/presence_weekday',
+           methods=['GET'])
+@jsonify
+def group_presence_weekday_view(group_id):
+    """
+    Returns total presence time of given group grouped by weekday.
+    """
+    summaries = get_group_summaries()
+    if group_id not in summaries:
+        log.debug('Group %s not found!', group_id)
+        return []
+
+    return presence_weekday_rows(summaries[group_id])
+
+
+@app.route('/api/v1/group/<string:group_id>/mean_time_weekday',
+           methods=['GET'])
+@jsonify
+def group_mean_time_weekday_view(group_id):
+    """
+    Returns mean presence time of given group grouped by weekday.
+    """
+    summaries = get_group_summaries()
+    if group_id not in summaries:
+        log.debug('Group %s not found!', group_id)
+        return []
+
+    return mean_time_weekday_rows(summaries[group_id])
+
+
+@app.route('/api/v1/group/<string:group_id>/presence_start_end',
+           methods=['GET'])
+@jsonify
+def group_presence_start_end_view(group_id):
+    """
+    Returns mean start and end time of work of given group.
+    """
+    summaries = get_group_summaries()
+    if group_id not in summaries:
+        log.debug('Group %s not found!', group_id)
+        return []
+
+    return presence_start_end_rows(summaries[group_id])
+
+
+@app.route('/api/v1/group/<string:group_id>/presence_quantiles',
+           methods=['GET'])
+@jsonify
+def group_presence_quantiles_view(group_id):
+    """
+    Returns median and 90th percentile of presence time, start and end of
+    work of given group grouped by weekday.
+    """
+    rows = get_group_quantile_rows()
+    if group_id not in rows:
+        log.debug('Group %s not found!', group_id)
+        return []
+
+    return rows[group_id]
+
+
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
 @jsonify
 def mean_time_weekday_view(user_id):